@@ -1,34 +1,47 @@
 import meteireann
+import aiohttp
 import asyncio
 import datetime
 
-weather_data = meteireann.WeatherData()
-warning_data = meteireann.WarningData()
+try:
+    # Optional faster event loop, installed with 'pip install PyMetEireann[fast]'
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
-async def fetch_data():
+async def fetch_data(weather_data, warning_data):
     """Fetch data from API - (current weather and forecast)."""
-    await weather_data.fetching_data()
-    current_weather_data = weather_data.get_current_weather()
+    # Look up the current time and local timezone once and share them
+    now = datetime.datetime.now(datetime.timezone.utc).astimezone()
+    time_zone = now.tzinfo
+
+    # The forecast and warning APIs are independent so fetch them concurrently
+    await asyncio.gather(weather_data.fetching_data(), warning_data.fetching_data())
+
+    current_weather_data = weather_data.get_current_weather(now)
     print('current:', current_weather_data)
 
-    await warning_data.fetching_data()
     current_warning_data = warning_data.get_warnings()
     print('warnings:', current_warning_data)
 
-    time_zone = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
-    daily_forecast = weather_data.get_forecast(time_zone, False)
+    daily_forecast = weather_data.get_forecast(time_zone, False, now)
     print('daily:', daily_forecast)
-    hourly_forecast = weather_data.get_forecast(time_zone, True)
+    hourly_forecast = weather_data.get_forecast(time_zone, True, now)
     print('hourly:', hourly_forecast)
     return True
 
 
 async def main():
-    await fetch_data()
-    await weather_data.close_session()
-    await warning_data.close_session()
+    # Share one session (and its connection pool) between both APIs
+    connector = aiohttp.TCPConnector(limit_per_host=5, keepalive_timeout=30, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        weather_data = meteireann.WeatherData(websession=session)
+        warning_data = meteireann.WarningData(websession=session)
+        await fetch_data(weather_data, warning_data)
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     loop = asyncio.get_event_loop()
     loop.run_until_complete(main())
@@ -1,13 +1,15 @@
 '''Library to handle communications with the Met Éireann forecast and weather warning APIs.'''
 import asyncio
 import datetime
+import functools
 import logging
-from xml.parsers.expat import ExpatError
+import math
+from collections import namedtuple
 
 import aiohttp
-import async_timeout
-import pytz
-import xmltodict
+import orjson
+from lxml import etree
+from yarl import URL
 
 API_URL = 'http://openaccess.pf.api.met.ie/metno-wdb2ts/locationforecast'
 WARNING_API_URL = 'https://www.met.ie/Open_Data/json/warning_'
@@ -65,8 +67,54 @@ REGION_MAP = {
     'EI825': 'IrishSea-IOM-N'
 }
 
+# Reverse lookup of region codes by (lowercase) region name
+_REGION_NAME_TO_CODE = {v.lower(): k for k, v in REGION_MAP.items()}
+
 _LOGGER = logging.getLogger(__name__)
 
+# Shared timeout applied to every API request
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+ONE_HOUR = datetime.timedelta(hours=1)
+ONE_DAY = datetime.timedelta(days=1)
+
+# A single forecast <time> entry, with the timestamps and values already parsed. The
+# timestamps are also stored as epoch seconds and dates for the get_weather hot loop.
+TimeEntry = namedtuple('TimeEntry', [
+    'valid_from',
+    'valid_to',
+    'from_ts',
+    'to_ts',
+    'from_date',
+    'to_date',
+    'symbol',
+    'temperature',
+    'pressure',
+    'humidity',
+    'precipitation',
+    'wind_speed',
+    'wind_gust',
+    'wind_direction',
+    'cloudiness',
+    'fog',
+], defaults=(None,) * 10)
+
+# Map each returned forecast key to the TimeEntry field taken from the nearest entry
+DAILY_FIELDS = {
+    'condition': 'symbol',
+    'pressure': 'pressure',
+    'humidity': 'humidity',
+    'wind_bearing': 'wind_direction',
+}
+HOURLY_FIELDS = {
+    **DAILY_FIELDS,
+    'temperature': 'temperature',
+    'precipitation': 'precipitation',
+    'wind_speed': 'wind_speed',
+    'wind_gust': 'wind_gust',
+    'cloudiness': 'cloudiness',
+}
+
 
 class WarningData:
     '''Representation of Met Éireann warning data.'''
@@ -81,79 +129,91 @@ class WarningData:
         self._convert_to_utc = convert_to_utc
 
         # Convert region name to region code (if applicable)
-        if not region.upper().startswith('EI') and region.upper() != 'IRELAND':
-            keys = [k for k, v in REGION_MAP.items() if v == region]
-            self._region = keys[0].upper()
+        if region.upper() == 'IRELAND':
+            self._region = 'IRELAND'
         else:
-            self._region = region.upper()
+            self._region = _REGION_NAME_TO_CODE.get(region.lower(), region).upper()
 
         # Set the API URL to include the required region
-        self._api_url = f'{api_url}{self._region}.json'
-
-        # Create a new session if one isn't passed in
-        if websession is None:
-            async def _create_session():
-                self.created_session = True
-                return aiohttp.ClientSession()
+        self._api_url = URL(f'{api_url}{self._region}.json')
 
-            loop = asyncio.get_event_loop()
-            self._websession = loop.run_until_complete(_create_session())
-        else:
-            self._websession = websession
-            self.created_session = False
+        # A new session is created on the first fetch if one isn't passed in
+        self._websession = websession
+        self.created_session = False
         self.data = None
+        # Cache validators from the last successful response, used to skip unchanged data
+        self._etag = None
+        self._last_modified = None
 
     async def fetching_data(self, *_):
         '''Get the latest data from the warning API'''
+        if self._websession is None:
+            self._websession = create_session()
+            self.created_session = True
         try:
-            with async_timeout.timeout(10):
-                res = await self._websession.get(self._api_url)
+            res = await self._websession.get(
+                self._api_url, headers=self._cache_headers(), timeout=REQUEST_TIMEOUT
+            )
+            # The warnings haven't changed since the last fetch so keep the existing data
+            if res.status == 304:
+                res.release()
+                return True
             # Log any 400+ HTTP error codes
             if res.status >= 400:
                 _LOGGER.error('%s returned %s', self._api_url, res.status)
                 return False
-            json = await res.json()
+            content = await res.read()
         except (asyncio.TimeoutError, aiohttp.ClientError) as err:
             _LOGGER.error('%s returned %s', self._api_url, err)
             return False
         try:
+            json = orjson.loads(content)
             self.data = {
                 'count': len(json),
                 'warnings': json
             }
-        except (ExpatError, IndexError) as err:
+        except (orjson.JSONDecodeError, TypeError) as err:
             _LOGGER.error('%s returned %s', res.url, err)
             return False
+        self._etag = res.headers.get('ETag')
+        self._last_modified = res.headers.get('Last-Modified')
         return True
 
+    def _cache_headers(self):
+        '''Build the conditional request headers for the cached data (if any).'''
+        return get_cache_headers(self.data, self._etag, self._last_modified)
+
     def get_warnings(self):
         '''Get the latest warnings from Met Éireann.'''
         if self.data is None:
             return {'count': 0, 'warnings': []}
 
-        # Update the timestamps to datetime objects (and to UTC if required)
+        ignore_blight = self._ignore_blight
+        convert_to_utc = self._convert_to_utc
+        warnings = []
         for entry in self.data['warnings']:
-            entry['issued'] = format_warning_date(entry['issued'], self._convert_to_utc)
-            entry['updated'] = format_warning_date(entry['updated'], self._convert_to_utc)
-            entry['onset'] = format_warning_date(entry['onset'], self._convert_to_utc)
-            entry['expiry'] = format_warning_date(entry['expiry'], self._convert_to_utc)
-
-        # Remove blight warnings from the list if required
-        if self._ignore_blight:
-            new_warnings_list = []
-            for entry in self.data['warnings']:
-                if entry['type'].lower() != 'blight':
-                    new_warnings_list.append(entry)
-            return {'count': len(new_warnings_list), 'warnings': new_warnings_list}
-
-        return self.data
+            # Skip blight warnings if required
+            if ignore_blight and entry.get('type', '').lower() == 'blight':
+                continue
+            # Convert the timestamps to datetime objects (and to UTC if required), leaving the
+            # fetched data untouched so the warnings can be read more than once
+            warnings.append({
+                **entry,
+                'issued': format_warning_date(entry['issued'], convert_to_utc),
+                'updated': format_warning_date(entry['updated'], convert_to_utc),
+                'onset': format_warning_date(entry['onset'], convert_to_utc),
+                'expiry': format_warning_date(entry['expiry'], convert_to_utc),
+            })
+        return {'count': len(warnings), 'warnings': warnings}
 
     async def close_session(self):
         '''Close a session if the user did not pass one in.'''
         if self.created_session:
             await self._websession.close()
+            self._websession = None
+            self.created_session = False
             _LOGGER.debug('Closed session (Warnings)')
-        else:
+        elif self._websession is not None:
             _LOGGER.warning('Cannot close an external session')
 
 
@@ -167,209 +227,297 @@ class WeatherData:
         # Get the current UTC time
         now = datetime.datetime.utcnow()
 
-        # Store the forecast parameters
-        self._api_url = f'{api_url}?lat={latitude};long={longitude};alt={altitude};from={now.date()}T{now.hour}:00'
+        # Store the forecast parameters, parsed once here rather than by aiohttp on every request
+        # (the API expects ';' separated parameters so the query string is built by hand)
+        self._api_url = URL(f'{api_url}?lat={latitude};long={longitude};alt={altitude};from={now.date()}T{now.hour}:00')
 
-        # Create a new session if one isn't passed in
-        if websession is None:
-            async def _create_session():
-                self.created_session = True
-                return aiohttp.ClientSession()
-
-            loop = asyncio.get_event_loop()
-            self._websession = loop.run_until_complete(_create_session())
-        else:
-            self._websession = websession
-            self.created_session = False
+        # A new session is created on the first fetch if one isn't passed in
+        self._websession = websession
+        self.created_session = False
         self.data = None
+        # Cache validators from the last successful response, used to skip unchanged data
+        self._etag = None
+        self._last_modified = None
 
     async def fetching_data(self, *_):
         '''Get the latest data from the API'''
+        if self._websession is None:
+            self._websession = create_session()
+            self.created_session = True
+        parser = create_forecast_parser()
+        entries = []
         try:
-            with async_timeout.timeout(10):
-                resp = await self._websession.get(self._api_url)
+            resp = await self._websession.get(
+                self._api_url, headers=self._cache_headers(), timeout=REQUEST_TIMEOUT
+            )
+            # The forecast hasn't changed since the last fetch so keep the existing data
+            if resp.status == 304:
+                resp.release()
+                return True
             # Log any 400+ HTTP error codes
             if resp.status >= 400:
                 _LOGGER.error('%s returned %s', self._api_url, resp.status)
                 return False
-            text = await resp.text()
+            # Parse the response as it arrives rather than buffering the whole body first
+            async for chunk in resp.content.iter_chunked(16384):
+                parser.feed(chunk)
+                read_forecast_entries(parser, entries)
+            parser.close()
+            read_forecast_entries(parser, entries)
         except (asyncio.TimeoutError, aiohttp.ClientError) as err:
             _LOGGER.error('%s returned %s', self._api_url, err)
             return False
-        try:
-            self.data = xmltodict.parse(text)['weatherdata']
-        except (ExpatError, IndexError) as err:
+        except (etree.XMLSyntaxError, ValueError, IndexError) as err:
             _LOGGER.error('%s returned %s', resp.url, err)
             return False
+        self.data = entries
+        self._etag = resp.headers.get('ETag')
+        self._last_modified = resp.headers.get('Last-Modified')
         return True
 
-    def get_current_weather(self):
+    def _cache_headers(self):
+        '''Build the conditional request headers for the cached data (if any).'''
+        return get_cache_headers(self.data, self._etag, self._last_modified)
+
+    def get_current_weather(self, now=None):
         '''Get the current weather data from Met Éireann.'''
-        return self.get_weather(datetime.datetime.now(pytz.utc).replace(minute=0, second=0, microsecond=0), hourly=True)
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        now = now.astimezone(datetime.timezone.utc)
+        return self.get_weather(now.replace(minute=0, second=0, microsecond=0), hourly=True)
 
-    def get_forecast(self, time_zone, hourly=False):
+    def get_forecast(self, time_zone, hourly=False, now=None):
         '''Get the forecast weather data from Met Éireann.'''
         if self.data is None:
             return []
 
+        # Allow the caller to share a single 'now' across several forecasts
+        now = datetime.datetime.now(time_zone) if now is None else now.astimezone(time_zone)
         if hourly:
-            now = datetime.datetime.now(time_zone).replace(
-                minute=0, second=0, microsecond=0
-            )
-            times = [now + datetime.timedelta(hours=k) for k in range(1, 25)]
+            now = now.replace(minute=0, second=0, microsecond=0)
+            times = [now + k * ONE_HOUR for k in range(1, 25)]
         else:
-            now = datetime.datetime.now(time_zone).replace(
-                hour=12, minute=0, second=0, microsecond=0
-            )
-            times = [now + datetime.timedelta(days=k) for k in range(1, 6)]
+            now = now.replace(hour=12, minute=0, second=0, microsecond=0)
+            times = [now + k * ONE_DAY for k in range(1, 6)]
         return [self.get_weather(_time, hourly=hourly) for _time in times]
 
     def get_weather(self, time, max_hour=6, hourly=False):
         '''Get the current weather data from Met Éireann.'''
-        # pylint: disable=too-many-locals
+        # pylint: disable=too-many-locals,too-many-branches
         if self.data is None:
             return {}
         day = time.date()
-        daily_temperatures = []
-        daily_precipitation = []
-        daily_windspeed = []
-        daily_windgust = []
-        ordered_entries = []
-        for time_entry in self.data['product']['time']:
-            valid_from = parse_datetime(time_entry['@from'])
-            valid_to = parse_datetime(time_entry['@to'])
-            if time > valid_to:
+        time_ts = time.timestamp()
+        max_dist = max_hour * 3600
+        fields = HOURLY_FIELDS if hourly else DAILY_FIELDS
+        temp_max = -math.inf
+        temp_min = math.inf
+        precipitation_sum = 0.0
+        precipitation_count = 0
+        wind_speed_max = -math.inf
+        wind_gust_max = -math.inf
+        # Track the (distance, value) of the nearest entry providing each field
+        nearest = dict.fromkeys(fields.values(), (math.inf, None))
+        found = False
+        for time_entry in self.data:
+            from_ts = time_entry.from_ts
+            to_ts = time_entry.to_ts
+            if time_ts > to_ts:
                 # Has already passed. Never select this.
                 continue
 
-            # Collect all daily values to calculate min/max/sum
-            if valid_from.date() == day or valid_to.date() == day:
-
-                if 'temperature' in time_entry['location']:
-                    daily_temperatures.append(
-                        get_value(time_entry['location']['temperature'], '@value')
-                    )
-                if 'precipitation' in time_entry['location']:
-                    daily_precipitation.append(
-                        get_value(time_entry['location']['precipitation'], '@value')
-                    )
-                if 'windSpeed' in time_entry['location']:
-                    daily_windspeed.append(
-                        get_value(time_entry['location']['windSpeed'], '@mps')
-                    )
-                if 'windGust' in time_entry['location']:
-                    daily_windgust.append(
-                        get_value(time_entry['location']['windGust'], '@mps')
-                    )
-
-            average_dist = abs((valid_to - time).total_seconds()) + abs(
-                (valid_from - time).total_seconds()
-            )
-
-            if average_dist > max_hour * 3600:
+            # Accumulate the daily min/max/sum values
+            if not hourly and (time_entry.from_date == day or time_entry.to_date == day):
+                # Compare inline rather than calling max()/min() for every entry
+                temperature = time_entry.temperature
+                if temperature is not None:
+                    if temperature > temp_max:
+                        temp_max = temperature
+                    if temperature < temp_min:
+                        temp_min = temperature
+                if time_entry.precipitation is not None:
+                    precipitation_sum += time_entry.precipitation
+                    precipitation_count += 1
+                wind_speed = time_entry.wind_speed
+                if wind_speed is not None and wind_speed > wind_speed_max:
+                    wind_speed_max = wind_speed
+                wind_gust = time_entry.wind_gust
+                if wind_gust is not None and wind_gust > wind_gust_max:
+                    wind_gust_max = wind_gust
+
+            average_dist = abs(to_ts - time_ts) + abs(from_ts - time_ts)
+
+            if average_dist > max_dist:
                 continue
 
-            ordered_entries.append((average_dist, time_entry))
+            found = True
+            for field in nearest:
+                value = getattr(time_entry, field)
+                if value is not None and average_dist < nearest[field][0]:
+                    nearest[field] = (average_dist, value)
 
-        if not ordered_entries:
+        if not found:
             return {}
-        ordered_entries.sort(key=lambda item: item[0])
         res = dict()
         res['datetime'] = time
-        res['condition'] = get_data('symbol', ordered_entries)
-        res['pressure'] = get_data('pressure', ordered_entries)
-        res['humidity'] = get_data('humidity', ordered_entries)
-        res['wind_bearing'] = get_data('windDirection', ordered_entries)
-        if hourly:
-            res['temperature'] = get_data('temperature', ordered_entries)
-            res['precipitation'] = get_data('precipitation', ordered_entries)
-            res['wind_speed'] = get_data('windSpeed', ordered_entries)
-            res['wind_gust'] = get_data('windGust', ordered_entries)
-            res['cloudiness'] = get_data('cloudiness', ordered_entries)
-        else:
-            res['temperature'] = (
-                None if daily_temperatures == [] else max(daily_temperatures)
-            )
-            res['templow'] = (
-                None if daily_temperatures == [] else min(daily_temperatures)
-            )
+        for key, field in fields.items():
+            res[key] = nearest[field][1]
+        if not hourly:
+            res['temperature'] = None if temp_max == -math.inf else temp_max
+            res['templow'] = None if temp_min == math.inf else temp_min
             res['precipitation'] = (
-                None if daily_precipitation == [] else round(sum(daily_precipitation), 1)
-            )
-            res['wind_speed'] = (
-                None if daily_windspeed == [] else max(daily_windspeed)
-            )
-            res['wind_gust'] = (
-                None if daily_windgust == [] else max(daily_windgust)
+                None if precipitation_count == 0 else round_one_decimal(precipitation_sum)
             )
+            res['wind_speed'] = None if wind_speed_max == -math.inf else wind_speed_max
+            res['wind_gust'] = None if wind_gust_max == -math.inf else wind_gust_max
         return res
 
     async def close_session(self):
         '''Close a session if the user did not pass one in'''
         if self.created_session:
             await self._websession.close()
+            self._websession = None
+            self.created_session = False
             _LOGGER.debug('Closed session (Forecast)')
-        else:
+        elif self._websession is not None:
             _LOGGER.warning('Cannot close an external session')
 
 
+def create_session():
+    '''Create a session with a connector tuned for the Met Éireann APIs.'''
+    connector = aiohttp.TCPConnector(ttl_dns_cache=300, happy_eyeballs_delay=0.25, limit_per_host=5)
+    return aiohttp.ClientSession(timeout=REQUEST_TIMEOUT, connector=connector)
+
+
+def get_cache_headers(data, etag, last_modified):
+    '''Build conditional GET headers so the API can reply 304 if the data hasn't changed.'''
+    headers = {}
+    # Only revalidate if there is existing data to fall back on
+    if data is None:
+        return headers
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
 def get_value(data, value):
     '''Retrieve weather value.'''
     try:
-        if value == '@mps':
-            return round(float(data[value]) * 3.6, 1)
-        return round(float(data[value]), 1)
-    except (ValueError, IndexError, KeyError):
+        number = float(data[value])
+    except (ValueError, IndexError, KeyError, TypeError):
         return None
-
-
-def get_data(param, data):
-    '''Retrieve weather parameter.'''
-    try:
-        for (_, selected_time_entry) in data:
-            loc_data = selected_time_entry['location']
-            if param not in loc_data:
-                continue
-            if param == 'symbol':
-                new_state = loc_data[param]['@id']
-            elif param in (
-                    'temperature',
-                    'pressure',
-                    'humidity',
-                    'dewpointTemperature',
-                    'precipitation',
-            ):
-                new_state = get_value(loc_data[param], '@value')
-            elif param in ('windSpeed', 'windGust'):
-                new_state = get_value(loc_data[param], '@mps')
-            elif param == 'windDirection':
-                new_state = get_value(loc_data[param], '@deg')
-            elif param in (
-                    'fog',
-                    'cloudiness',
-                    'lowClouds',
-                    'mediumClouds',
-                    'highClouds',
-            ):
-                new_state = get_value(loc_data[param], '@percent')
-            return new_state
-    except (ValueError, IndexError, KeyError):
+    if not math.isfinite(number):
         return None
+    if value == 'mps':
+        number *= 3.6
+    return round_one_decimal(number)
+
+
+def round_one_decimal(number):
+    '''Round a finite number to one decimal place (halves away from zero) without round().'''
+    return int(number * 10.0 + (0.5 if number >= 0 else -0.5)) / 10.0
+
+
+def create_forecast_parser():
+    '''Create an incremental parser which reports each completed forecast <time> element.'''
+    # The forecast values are all attributes, so skip building whitespace text and comment nodes
+    return etree.XMLPullParser(events=('end',), tag='time', remove_blank_text=True, remove_comments=True)
+
+
+def read_forecast_entries(parser, entries):
+    '''Convert the <time> elements completed so far into time entries.'''
+    for _, elem in parser.read_events():
+        entries.append(parse_time_entry(elem))
+        # Free the processed element (and any preceding siblings) to keep memory flat
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def parse_forecast(content):
+    '''Parse a complete forecast XML document into a list of time entries.'''
+    parser = create_forecast_parser()
+    entries = []
+    parser.feed(content)
+    parser.close()
+    read_forecast_entries(parser, entries)
+    return entries
+
+
+# Map each forecast XML tag to its TimeEntry field and a function reading the value from its attributes
+ENTRY_HANDLERS = {
+    'symbol': ('symbol', lambda attrib: attrib.get('id')),
+    'temperature': ('temperature', functools.partial(get_value, value='value')),
+    'pressure': ('pressure', functools.partial(get_value, value='value')),
+    'humidity': ('humidity', functools.partial(get_value, value='value')),
+    'precipitation': ('precipitation', functools.partial(get_value, value='value')),
+    'windSpeed': ('wind_speed', functools.partial(get_value, value='mps')),
+    'windGust': ('wind_gust', functools.partial(get_value, value='mps')),
+    'windDirection': ('wind_direction', functools.partial(get_value, value='deg')),
+    'cloudiness': ('cloudiness', functools.partial(get_value, value='percent')),
+    'fog': ('fog', functools.partial(get_value, value='percent')),
+}
 
 
+def parse_time_entry(elem):
+    '''Convert a forecast <time> element into a TimeEntry.'''
+    values = {}
+    location = elem.find('location')
+    if location is not None:
+        for child in location:
+            handler = ENTRY_HANDLERS.get(child.tag)
+            if handler is not None:
+                field, get_field_value = handler
+                values[field] = get_field_value(child.attrib)
+    valid_from = parse_datetime(elem.get('from'))
+    valid_to = parse_datetime(elem.get('to'))
+    return TimeEntry(
+        valid_from, valid_to,
+        valid_from.timestamp(), valid_to.timestamp(),
+        valid_from.date(), valid_to.date(),
+        **values
+    )
+
+
+@functools.lru_cache(maxsize=8192)
 def parse_datetime(dt_str):
     '''Parse datetime for forecast data.'''
-    date_format = '%Y-%m-%dT%H:%M:%S %z'
-    dt_str = dt_str.replace('Z', ' +0000')
-    return datetime.datetime.strptime(dt_str, date_format)
+    return parse_iso_timestamp(dt_str)
 
 
+@functools.lru_cache(maxsize=8192)
 def format_warning_date(date_str, convert_to_utc=False):
     '''Convert a timestamp string to datetime and convert to UTC if required.'''
-    date_format = '%Y-%m-%dT%H:%M:%S%z'
-    new_timestamp = datetime.datetime.strptime(date_str, date_format)
+    new_timestamp = parse_iso_timestamp(date_str)
     # Convert the datetime object to UTC if required
     if convert_to_utc:
         return new_timestamp.astimezone(tz=datetime.timezone.utc)
     # Return just the datetime object if UTC isn't required
     return new_timestamp
+
+
+def parse_iso_timestamp(timestamp):
+    '''Parse a fixed width ISO-8601 timestamp without the overhead of strptime.'''
+    if len(timestamp) < 20 or timestamp[4] != '-' or timestamp[10] != 'T' or timestamp[13] != ':':
+        raise ValueError(f'Invalid timestamp: {timestamp}')
+    return datetime.datetime(
+        int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+        tzinfo=parse_utc_offset(timestamp[19:])
+    )
+
+
+def parse_utc_offset(offset):
+    '''Convert a UTC offset string (Z, +0000, +00:00) to a timezone.'''
+    offset = offset.strip()
+    if offset == 'Z':
+        return datetime.timezone.utc
+    offset = offset.replace(':', '')
+    if len(offset) != 5 or offset[0] not in '+-':
+        raise ValueError(f'Invalid UTC offset: {offset}')
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    if minutes == 0:
+        return datetime.timezone.utc
+    return datetime.timezone(datetime.timedelta(minutes=-minutes if offset[0] == '-' else minutes))